@@ -5,8 +5,14 @@ import io
 import os
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from services.pdf_processor import convert_pdf_to_images
-from services.vision_processor import analyze_slide_image, crop_figures_from_slide
+from PIL import Image
+from pymupdf import FileDataError
+from contextlib import asynccontextmanager
+from functools import partial
+from services.pdf_processor import convert_pdf_to_images, extract_image_bytes, list_page_images, render_page_region
+from services.vision_processor import (ANALYSIS_BATCH_SIZE, ANALYSIS_MAX_DIM, analyze_slide_batch_async,
+                                       close_client, crop_figures_from_slide, new_analysis_cache,
+                                       warm_up_client)
 from services.ppt_builder import generate_pptx
 
 import logging
@@ -16,10 +22,30 @@ import sys
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Prime the shared vision API connection so the first upload skips the TLS handshake
+    await warm_up_client()
+    yield
+    await close_client()
 
-# Thread pool for parallel processing (limit to 3 concurrent API calls to avoid rate limits)
-executor = ThreadPoolExecutor(max_workers=3)
+
+app = FastAPI(lifespan=lifespan)
+
+# Pipeline sizing: rasterize -> analyze -> crop, connected by bounded queues.
+# ANALYSIS_WORKERS is the number of batches (of up to ANALYSIS_BATCH_SIZE slides)
+# in flight per upload; the API calls themselves are async and additionally capped
+# process-wide in vision_processor. PIPELINE_QUEUE_SIZE caps how many rendered
+# pages wait in RAM between stages, and is sized so every worker can fill a batch.
+ANALYSIS_WORKERS = 3
+CROP_WORKERS = 2
+PIPELINE_QUEUE_SIZE = ANALYSIS_WORKERS * ANALYSIS_BATCH_SIZE
+
+# Block size used when streaming the generated PPTX back to the client
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Thread pool for the CPU-bound stages (rasterizing, downscaling and cropping)
+executor = ThreadPoolExecutor(max_workers=1 + ANALYSIS_WORKERS + CROP_WORKERS)
 
 # Mount static files for the UI
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -30,26 +56,165 @@ async def read_index():
         return f.read()
 
 
-def process_single_slide(args: tuple) -> dict:
-    """Process a single slide - runs in thread pool"""
-    idx, img, total = args
-    logger.info(f"Processing slide {idx+1}/{total}...")
-    
-    # Analyze Layout
-    slide_analysis = analyze_slide_image(img)
-    logger.info(f"Slide {idx+1} analysis: {slide_analysis.get('layout_type', 'unknown layout')}")
-    logger.info(f"Slide {idx+1} title: {slide_analysis.get('title', 'NO TITLE')}")
-    
-    # Crop Figures if any
+def downscale_for_analysis(batch: list[tuple]) -> list[Image.Image]:
+    """Downscaled copies of a batch of (idx, img) slides - runs in thread pool"""
+    # Layout is analyzed on downscaled copies; the full-res pages are kept for cropping
+    # (box_2d is on a 0-1000 scale, so no coordinate remap is needed)
+    smalls = []
+    for _, img in batch:
+        # Integer reduce() (a cheap box average) takes off the bulk of the scale,
+        # and only the last < 2x step is resampled with LANCZOS. Both return new
+        # images, so the full-res page is never duplicated.
+        factor = max(img.size) // ANALYSIS_MAX_DIM
+        small = img.reduce(factor) if factor > 1 else img
+        scale = min(1.0, ANALYSIS_MAX_DIM / max(small.size))
+        size = (max(1, round(small.width * scale)), max(1, round(small.height * scale)))
+        smalls.append(small.resize(size, Image.Resampling.LANCZOS))
+    return smalls
+
+
+def crop_single_slide(pdf_bytes: bytes, idx: int, img, slide_analysis: dict) -> dict:
+    """Crop the figures of an analyzed slide - runs in thread pool"""
+    # Crop Figures if any (images embedded in the PDF are reused as stored,
+    # other large ones are re-rendered from the PDF at high DPI)
     if slide_analysis.get("figures"):
         logger.info(f"Cropping {len(slide_analysis['figures'])} figures for slide {idx+1}")
-        slide_analysis["figures"] = crop_figures_from_slide(img, slide_analysis["figures"])
+        slide_analysis["figures"] = crop_figures_from_slide(
+            img, slide_analysis["figures"],
+            render_region=partial(render_page_region, pdf_bytes, idx),
+            embedded_images=list_page_images(pdf_bytes, idx),
+            load_embedded=partial(extract_image_bytes, pdf_bytes),
+        )
+    
+    # The page bitmap is not needed past this stage; release it right away
+    img.close()
     
     # Store index for ordering later
     slide_analysis["_idx"] = idx
     return slide_analysis
 
 
+async def _rasterize_stage(pdf_bytes: bytes, page_queue: asyncio.Queue):
+    """Render pages one at a time and feed them to the analysis workers."""
+    loop = asyncio.get_running_loop()
+    # Pages are pulled lazily: at most PIPELINE_QUEUE_SIZE rendered pages wait for analysis
+    pages = convert_pdf_to_images(pdf_bytes)
+    idx = 0
+    try:
+        while True:
+            # next() blocks on the renderer, so pull each page from the thread pool
+            img = await loop.run_in_executor(executor, next, pages, None)
+            if img is None:
+                break
+            await page_queue.put((idx, img))
+            idx += 1
+    finally:
+        # If the pipeline is torn down early, release the open document now rather
+        # than at garbage collection (unless a render is still running in its thread).
+        # Closing takes the MuPDF lock, so it runs in the pool like the renders do.
+        if not pages.gi_running:
+            await loop.run_in_executor(executor, pages.close)
+    
+    logger.info(f"Converted PDF to {idx} images")
+    for _ in range(ANALYSIS_WORKERS):
+        await page_queue.put(None)
+
+
+async def _analyze_stage(page_queue: asyncio.Queue, crop_queue: asyncio.Queue, analysis_cache: dict):
+    """Consume rendered pages in batches, analyze them and hand them to the crop workers."""
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        item = await page_queue.get()
+        if item is None:
+            break
+        
+        # Top the batch up with whatever pages are already rendered, without waiting
+        batch = [item]
+        while len(batch) < ANALYSIS_BATCH_SIZE:
+            try:
+                item = page_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is None:
+                done = True
+                break
+            batch.append(item)
+        
+        logger.info(f"Processing slides {', '.join(str(idx+1) for idx, _ in batch)}...")
+        smalls = await loop.run_in_executor(executor, downscale_for_analysis, batch)
+        analyses = await analyze_slide_batch_async(smalls, analysis_cache)
+        for small in smalls:
+            small.close()
+        
+        for (idx, img), slide_analysis in zip(batch, analyses):
+            logger.info(f"Slide {idx+1} analysis: {slide_analysis.get('layout_type', 'unknown layout')}")
+            logger.info(f"Slide {idx+1} title: {slide_analysis.get('title', 'NO TITLE')}")
+            await crop_queue.put((idx, img, slide_analysis))
+
+
+async def _crop_stage(pdf_bytes: bytes, crop_queue: asyncio.Queue, results: list[dict],
+                      unique_images: dict[bytes, bytes]):
+    """Consume analyzed pages and collect the finished slide data."""
+    loop = asyncio.get_running_loop()
+    while (item := await crop_queue.get()) is not None:
+        slide_analysis = await loop.run_in_executor(executor, crop_single_slide, pdf_bytes, *item)
+        
+        # Recurring figures (logos, icons) share a single bytes object across slides.
+        # python-pptx already embeds each distinct image once, keyed by its SHA-1.
+        for figure in slide_analysis.get("figures", []):
+            if "image_bytes" in figure:
+                figure["image_bytes"] = unique_images.setdefault(figure["image_bytes"], figure["image_bytes"])
+        results.append(slide_analysis)
+
+
+async def process_pdf(pdf_bytes: bytes) -> list[dict]:
+    """
+    Run the rasterize -> analyze -> crop pipeline over a PDF.
+    
+    Analysis of page 1 starts as soon as it is rendered, and peak memory is bounded
+    by the queue depth rather than by the page count.
+    """
+    page_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    crop_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results = []
+    unique_images = {}
+    # Repeated slides within this upload are analyzed once; nothing outlives the request
+    analysis_cache = new_analysis_cache()
+    
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(_rasterize_stage(pdf_bytes, page_queue))
+            analyzers = [tg.create_task(_analyze_stage(page_queue, crop_queue, analysis_cache)) for _ in range(ANALYSIS_WORKERS)]
+            for _ in range(CROP_WORKERS):
+                tg.create_task(_crop_stage(pdf_bytes, crop_queue, results, unique_images))
+            
+            # Once every analyzer has drained the page queue, stop the crop workers
+            await asyncio.gather(*analyzers)
+            for _ in range(CROP_WORKERS):
+                await crop_queue.put(None)
+    except ExceptionGroup as eg:
+        # The first failing stage cancels the others; report its error, not the group
+        raise eg.exceptions[0] from None
+    
+    # Sort by original index to maintain order
+    slides_data = sorted(results, key=lambda x: x.get("_idx", 0))
+    
+    # Remove the temporary index field
+    for slide in slides_data:
+        slide.pop("_idx", None)
+    
+    return slides_data
+
+
+def _iter_chunks(buffer: io.BytesIO, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Yield a buffer in fixed-size blocks, then release it."""
+    # Iterating a BytesIO directly splits binary data on b"\n", i.e. arbitrary-sized chunks
+    with buffer:
+        while chunk := buffer.read(chunk_size):
+            yield chunk
+
+
 @app.post("/rebuild")
 async def rebuild_pptx(file: UploadFile = File(...)):
     """
@@ -66,30 +231,9 @@ async def rebuild_pptx(file: UploadFile = File(...)):
         pdf_bytes = await file.read()
         logger.info(f"Read {len(pdf_bytes)} bytes")
         
-        # 1. Convert PDF to Images
-        logger.info("Converting PDF to images...")
-        images = list(convert_pdf_to_images(pdf_bytes))
-        logger.info(f"Converted PDF to {len(images)} images")
-        
-        # 2 & 3. Analyze each page in PARALLEL
-        logger.info("Starting parallel slide analysis...")
-        loop = asyncio.get_event_loop()
-        
-        # Create tasks for parallel processing
-        tasks = [
-            loop.run_in_executor(executor, process_single_slide, (i, img, len(images)))
-            for i, img in enumerate(images)
-        ]
-        
-        # Wait for all slides to be processed
-        results = await asyncio.gather(*tasks)
-        
-        # Sort by original index to maintain order
-        slides_data = sorted(results, key=lambda x: x.get("_idx", 0))
-        
-        # Remove the temporary index field
-        for slide in slides_data:
-            slide.pop("_idx", None)
+        # 1-3. Rasterize, analyze and crop each page in a PARALLEL pipeline
+        logger.info("Starting slide processing pipeline...")
+        slides_data = await process_pdf(pdf_bytes)
         
         logger.info(f"All {len(slides_data)} slides processed")
             
@@ -99,16 +243,22 @@ async def rebuild_pptx(file: UploadFile = File(...)):
              raise HTTPException(status_code=422, detail="No slides could be processed from the PDF.")
              
         logger.info("Generating PPTX file...")
-        pptx_buffer = generate_pptx(slides_data)
+        # Building the deck is CPU-bound; keep it off the event loop so other
+        # uploads' API calls keep flowing meanwhile
+        pptx_buffer = await asyncio.get_running_loop().run_in_executor(executor, generate_pptx, slides_data)
         logger.info("PPTX generation complete")
         
-        # Return as downloadable file
+        # Return as downloadable file, streamed in fixed-size chunks
         return StreamingResponse(
-            pptx_buffer,
+            _iter_chunks(pptx_buffer),
             media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation",
             headers={"Content-Disposition": f"attachment; filename=rebuilt_{file.filename.split('.')[0]}.pptx"}
         )
 
+    except FileDataError as e:
+        logger.error(f"Unreadable PDF: {str(e)}")
+        raise HTTPException(status_code=400, detail="Invalid or corrupt PDF file.")
+
     except Exception as e:
         # In a real app, you'd log this properly
         logger.error(f"Error during processing: {str(e)}", exc_info=True)
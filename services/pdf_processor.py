@@ -1,20 +1,148 @@
-from pdf2image import convert_from_bytes
+import threading
+import pymupdf
 from PIL import Image
 from typing import Iterator
 
-def convert_pdf_to_images(pdf_bytes: bytes) -> Iterator[Image.Image]:
+# Page renders only need to be sharp enough for layout analysis and small crops;
+# large figures are re-rendered from the PDF at FIGURE_DPI instead.
+RENDER_DPI = 150
+FIGURE_DPI = 288
+
+# Embedded image formats that can be placed in the PPTX exactly as stored
+EMBEDDABLE_IMAGE_EXTS = {"jpeg", "png"}
+
+# Images covering at least this fraction of the page are page backgrounds or a
+# flattened slide (the whole page as one raster), never a figure on their own
+FULL_PAGE_IMAGE_MIN_COVERAGE = 0.9
+
+# Image dictionary entries that change how an image is drawn compared to its stored
+# bytes (soft mask, colour-key/explicit mask, stencil mask)
+MASK_KEYS = ("SMask", "Mask", "ImageMask")
+
+# MuPDF is not thread-safe, and the rasterizer and crop workers run in a thread pool:
+# every MuPDF call, including opening/closing documents and freeing pages and
+# pixmaps, happens while holding this lock
+_render_lock = threading.Lock()
+
+
+def _to_pil(pix: pymupdf.Pixmap) -> Image.Image:
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def convert_pdf_to_images(pdf_bytes: bytes, dpi: int = RENDER_DPI) -> Iterator[Image.Image]:
     """
-    Converts a PDF (from bytes) into high-resolution PIL images, yielding one page at a time.
+    Converts a PDF (from bytes) into PIL images, yielding one page at a time.
     
     Args:
         pdf_bytes: The byte content of the PDF file.
+        dpi: Render resolution of each page.
         
     Yields:
         A PIL Image object for each page of the PDF.
     """
-    # convert_from_bytes takes the PDF data and returns a list of PIL Images.
-    # We yield them to keep memory usage lower if we were processing many pages.
-    # Note: dpi=300 is used for high-quality extraction of charts later.
-    images = convert_from_bytes(pdf_bytes, dpi=300)
-    for image in images:
-        yield image
+    # PyMuPDF renders in-process straight into an RGB buffer, so there is no
+    # pdftoppm subprocess and no PPM encode/decode round-trip per page.
+    matrix = pymupdf.Matrix(dpi / 72, dpi / 72)
+    with _render_lock:
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        for page_index in range(doc.page_count):
+            with _render_lock:
+                page = doc[page_index]
+                pix = page.get_pixmap(matrix=matrix, alpha=False)
+                image = _to_pil(pix)
+                # Release the pixmap before handing the page on
+                del pix, page
+            yield image
+    finally:
+        with _render_lock:
+            doc.close()
+
+
+def render_page_region(pdf_bytes: bytes, page_index: int, box_2d: list, dpi: int = FIGURE_DPI) -> Image.Image:
+    """
+    Render a single region of a PDF page straight from the vector source.
+    
+    Args:
+        pdf_bytes: The byte content of the PDF file.
+        page_index: Zero-based index of the page.
+        box_2d: Region as [ymin, xmin, ymax, xmax] on a 0-1000 scale.
+        dpi: Render resolution of the region.
+        
+    Returns:
+        A PIL Image of the region.
+    """
+    ymin, xmin, ymax, xmax = box_2d
+    with _render_lock, pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc[page_index]
+        rect = page.rect
+        clip = pymupdf.Rect(
+            rect.x0 + xmin / 1000 * rect.width, rect.y0 + ymin / 1000 * rect.height,
+            rect.x0 + xmax / 1000 * rect.width, rect.y0 + ymax / 1000 * rect.height,
+        ) & rect
+        pix = page.get_pixmap(matrix=pymupdf.Matrix(dpi / 72, dpi / 72), clip=clip, alpha=False)
+        image = _to_pil(pix)
+        del pix, page
+    return image
+
+
+def list_page_images(pdf_bytes: bytes, page_index: int) -> list[dict]:
+    """
+    Locate the raster images embedded in a PDF page, without decoding them.
+    
+    Args:
+        pdf_bytes: The byte content of the PDF file.
+        page_index: Zero-based index of the page.
+        
+    Returns:
+        A list of {"box_2d": [ymin, xmin, ymax, xmax] on a 0-1000 scale,
+        "xref": int} dicts, to be passed to extract_image_bytes. Images drawn
+        rotated or flipped, covering (nearly) the whole page, masked in any way
+        (soft, colour-key or explicit masks) or used as a stencil mask are
+        skipped, since their stored bytes do not look like the page.
+    """
+    images = []
+    with _render_lock, pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc[page_index]
+        rotated = page.rotation
+        rect = page.rect
+        infos = [] if rotated else page.get_image_info(xrefs=True)
+        del page
+        for info in infos:
+            a, b, c, d, _, _ = info["transform"]
+            if not info["xref"] or b or c or a <= 0 or d <= 0:
+                continue
+            visible = pymupdf.Rect(info["bbox"]) & rect
+            if visible.is_empty or visible.get_area() >= FULL_PAGE_IMAGE_MIN_COVERAGE * rect.get_area():
+                continue
+            if any(doc.xref_get_key(info["xref"], key)[0] != "null" for key in MASK_KEYS):
+                continue
+            x0, y0, x1, y1 = info["bbox"]
+            images.append({
+                "box_2d": [
+                    (y0 - rect.y0) / rect.height * 1000, (x0 - rect.x0) / rect.width * 1000,
+                    (y1 - rect.y0) / rect.height * 1000, (x1 - rect.x0) / rect.width * 1000,
+                ],
+                "xref": info["xref"],
+            })
+    return images
+
+
+def extract_image_bytes(pdf_bytes: bytes, xref: int) -> bytes | None:
+    """
+    Extract one embedded image (an xref from list_page_images) as stored in the PDF.
+    
+    Args:
+        pdf_bytes: The byte content of the PDF file.
+        xref: Cross-reference number of the image.
+        
+    Returns:
+        The image file bytes, or None if it is in a format PowerPoint cannot embed.
+    """
+    # Only called for images a figure actually matched: for anything but JPEG,
+    # MuPDF re-encodes the image here, which is slow for large ones
+    with _render_lock, pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        extracted = doc.extract_image(xref)
+    if extracted["ext"] not in EMBEDDABLE_IMAGE_EXTS:
+        return None
+    return extracted["image"]
@@ -1,11 +1,37 @@
+import re
 import logging
+from xml.sax.saxutils import escape
 from pptx import Presentation
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls
 from pptx.util import Inches, Pt, Emu
 from pptx.enum.text import PP_ALIGN
+from pptx.opc.packuri import PackURI
 from io import BytesIO
 
 logger = logging.getLogger(__name__)
 
+# Geometry and fonts shared by every slide, converted to EMU once
+SLIDE_WIDTH = 10  # inches, default 4:3 Presentation()
+BLANK_LAYOUT_IDX = 6
+_TITLE_LEFT, _TITLE_TOP = Inches(0.5), Inches(0.3)
+_TITLE_WIDTH, _TITLE_HEIGHT = Inches(9), Inches(0.8)
+_TITLE_FONT_SIZE = Pt(28)
+_PARA_SPACE_AFTER = Pt(4)
+_PARA_SPACE_BEFORE = Pt(2)
+
+# Body paragraph markup, matching what _Paragraph.font.size/space_before/space_after produce
+_NSDECLS = nsdecls("a", "p")
+_PARAGRAPH_OPEN = (
+    '<a:p><a:pPr>'
+    f'<a:spcBef><a:spcPts val="{_PARA_SPACE_BEFORE.centipoints}"/></a:spcBef>'
+    f'<a:spcAft><a:spcPts val="{_PARA_SPACE_AFTER.centipoints}"/></a:spcAft>'
+    '<a:defRPr sz="{sz}"/>'
+    '</a:pPr>'
+)
+# Characters that are not allowed in XML 1.0 text
+_INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
 
 def generate_pptx(slides_data: list[dict]) -> BytesIO:
     """
@@ -13,6 +39,9 @@ def generate_pptx(slides_data: list[dict]) -> BytesIO:
     """
     logger.info(f"Starting PPTX generation with {len(slides_data)} slides")
     prs = Presentation()
+    _track_partnames(prs.part.package)
+    # Always use blank layout for maximum control
+    slide_layout = prs.slide_layouts[BLANK_LAYOUT_IDX]
 
     for idx, slide_data in enumerate(slides_data):
         l_type = slide_data.get("layout_type", "title_and_content")
@@ -23,8 +52,6 @@ def generate_pptx(slides_data: list[dict]) -> BytesIO:
         
         logger.info(f"Building slide {idx+1}: {l_type}")
         
-        # Always use blank layout for maximum control
-        slide_layout = prs.slide_layouts[6]  # Blank
         slide = prs.slides.add_slide(slide_layout)
         
         has_figures = len(figures) > 0
@@ -33,14 +60,14 @@ def generate_pptx(slides_data: list[dict]) -> BytesIO:
         # --- TITLE (always at top) ---
         if title_text:
             title_box = slide.shapes.add_textbox(
-                Inches(0.5), Inches(0.3), 
-                Inches(9), Inches(0.8)
+                _TITLE_LEFT, _TITLE_TOP,
+                _TITLE_WIDTH, _TITLE_HEIGHT
             )
             tf = title_box.text_frame
             tf.word_wrap = True
             p = tf.paragraphs[0]
             p.text = title_text
-            p.font.size = Pt(28)
+            p.font.size = _TITLE_FONT_SIZE
             p.font.bold = True
             p.alignment = PP_ALIGN.LEFT
         
@@ -90,6 +117,29 @@ def generate_pptx(slides_data: list[dict]) -> BytesIO:
     return pptx_buffer
 
 
+def _track_partnames(package):
+    """
+    Make package.next_partname O(1) while a deck is being built.
+    
+    python-pptx picks the next free part name (for every notes slide, for
+    instance) by walking every part in the package, which makes building a deck
+    quadratic in its slide count. Nothing else adds parts during generate_pptx,
+    so after the first lookup per template the next name is the previous + 1.
+    """
+    next_partname = package.next_partname
+    last_idx = {}
+    
+    def tracked_next_partname(tmpl: str) -> PackURI:
+        if tmpl in last_idx:
+            last_idx[tmpl] += 1
+            return PackURI(tmpl % last_idx[tmpl])
+        partname = next_partname(tmpl)
+        last_idx[tmpl] = partname.idx
+        return partname
+    
+    package.next_partname = tracked_next_partname
+
+
 def _add_body_text(slide, items: list[str], left: float, top: float, 
                    width: float, height: float, font_size: int = 14):
     """Add a text box with content that fits within bounds."""
@@ -112,43 +162,43 @@ def _add_body_text(slide, items: list[str], left: float, top: float,
     elif total_chars > 400:
         font_size = min(font_size, 12)
     
-    for i, item in enumerate(items):
-        if i == 0:
-            p = tf.paragraphs[0]
-        else:
-            p = tf.add_paragraph()
-        
-        p.text = item.strip()
-        p.font.size = Pt(font_size)
-        p.space_after = Pt(4)
-        p.space_before = Pt(2)
+    # Build every paragraph as one XML fragment and attach it in a single step,
+    # instead of going through python-pptx's per-property wrappers per bullet
+    paragraph_open = _PARAGRAPH_OPEN.format(sz=font_size * 100)
+    paragraphs = "".join(
+        paragraph_open + _paragraph_runs(item.strip()) + "</a:p>" for item in items
+    )
+    fragment = parse_xml(f"<p:txBody {_NSDECLS}>{paragraphs}</p:txBody>")
+    
+    txBody = tf._txBody
+    for p in txBody.p_lst:
+        txBody.remove(p)
+    txBody.extend(list(fragment))
+
+
+def _paragraph_runs(text: str) -> str:
+    """Run XML for one paragraph, with line breaks as <a:br/> (as _Paragraph.text does)."""
+    text = _INVALID_XML_CHARS.sub("", text.replace("\v", "\n"))
+    return "<a:br/>".join(
+        f"<a:r><a:t>{escape(line)}</a:t></a:r>" if line else "" for line in text.split("\n")
+    )
 
 
 def _add_centered_image(slide, figure: dict, top: float, max_width: float, max_height: float):
     """Add a centered image that fits within bounds."""
-    if "image_bytes" not in figure:
-        return
-    
-    image_stream = BytesIO(figure["image_bytes"])
-    left = (10 - max_width) / 2
-    
-    try:
-        pic = slide.shapes.add_picture(image_stream, Inches(left), Inches(top), width=Inches(max_width))
-        
-        if pic.height.inches > max_height:
-            scale = max_height / pic.height.inches
-            pic.width = Emu(int(pic.width * scale))
-            pic.height = Emu(int(pic.height * scale))
-            pic.left = Inches((10 - pic.width.inches) / 2)
-    except Exception as e:
-        logger.error(f"Error adding image: {e}")
+    pic = _add_image_at(slide, figure, left=(SLIDE_WIDTH - max_width) / 2, top=top,
+                        max_width=max_width, max_height=max_height)
+    if pic is not None:
+        pic.left = Emu((Inches(SLIDE_WIDTH) - pic.width) // 2)
 
 
 def _add_image_at(slide, figure: dict, left: float, top: float, max_width: float, max_height: float):
-    """Add an image at a specific position."""
+    """Add an image at a specific position. Returns the picture shape, or None."""
     if "image_bytes" not in figure:
-        return
+        return None
     
+    # BytesIO over an existing bytes object shares its buffer (no copy), and
+    # python-pptx reuses the image part of any identical blob by SHA-1
     image_stream = BytesIO(figure["image_bytes"])
     
     try:
@@ -158,5 +208,7 @@ def _add_image_at(slide, figure: dict, left: float, top: float, max_width: float
             scale = max_height / pic.height.inches
             pic.width = Emu(int(pic.width * scale))
             pic.height = Emu(int(pic.height * scale))
+        return pic
     except Exception as e:
         logger.error(f"Error adding image: {e}")
+        return None
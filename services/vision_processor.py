@@ -1,42 +1,142 @@
 import os
 import io
 import json
+import time
 import base64
+import asyncio
+import hashlib
 import logging
-from openai import OpenAI
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from PIL import Image
 from dotenv import load_dotenv
 
 logger = logging.getLogger(__name__)
 
+try:
+    # SIMD (SSSE3/AVX2) base64, straight to str
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(data) -> str:
+        return base64.b64encode(data).decode("ascii")
+
+try:
+    # Faster JSON parsing/serialization, working in bytes
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY not found!")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-MODEL_NAME = "gpt-4o"
+# Vision model for slide analysis (override with VISION_MODEL, e.g. "gpt-4o-mini")
+MODEL_NAME = os.getenv("VISION_MODEL", "gpt-4o")
 
+# Caps in-flight API calls across all requests on an event loop, to stay within rate limits
+MAX_CONCURRENT_REQUESTS = 8
 
-def encode_image(image: Image.Image) -> str:
-    """Encode image to base64, resizing for API efficiency."""
-    buffered = io.BytesIO()
-    img_copy = image.copy()
-    img_copy.thumbnail((1536, 1536))  # Larger for better text recognition
-    img_copy.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+# Per-call timeouts: fail fast on a dead connect, but leave room for a full
+# batched response to come back
+API_TIMEOUT = httpx.Timeout(180.0, connect=10.0)
 
+# One shared HTTP/2 transport: concurrent calls multiplex over a kept-alive
+# connection instead of each paying its own TLS handshake. Failed connects are
+# retried by the SDK (max_retries), so the transport adds no retries of its own.
+def _new_client() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=API_TIMEOUT,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS,
+                                max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+                                keepalive_expiry=30),
+        ),
+    )
 
-def analyze_slide_image(image: Image.Image) -> dict:
-    """
-    Analyze a slide image and extract structured content.
-    Focus: Complete text extraction with minimal image cropping.
-    """
-    try:
-        base64_image = encode_image(image)
 
-        prompt = """You are a slide content extractor. Analyze this slide image and extract ALL text content.
+# The HTTP pool and the semaphore are bound to the event loop they are first used
+# on, so each running loop (the app's, or each asyncio.run) gets its own pair.
+# Entries are only removed by close_client(): whoever opens a loop's pair closes it
+# (the app lifespan, or analyze_slides on a loop that had none).
+_loop_clients: dict[asyncio.AbstractEventLoop, tuple[AsyncOpenAI, asyncio.Semaphore]] = {}
+
+
+def _get_client() -> tuple[AsyncOpenAI, asyncio.Semaphore]:
+    """The API client and request semaphore of the running event loop."""
+    loop = asyncio.get_running_loop()
+    state = _loop_clients.get(loop)
+    if state is None:
+        state = _loop_clients[loop] = (_new_client(), asyncio.Semaphore(MAX_CONCURRENT_REQUESTS))
+    return state
+
+# Longest edge (px) of the slide image sent for analysis. The vision model tiles
+# images far below the page render, so extra pixels only cost upload time.
+ANALYSIS_MAX_DIM = 1024
+ANALYSIS_JPEG_QUALITY = 85
+
+# Crops smaller than this (px per side, at the 150 DPI page render) are discarded
+MIN_FIGURE_SIZE = 25
+
+# Figures covering at least this many page pixels are re-rendered at high DPI
+# through render_region instead of being cropped from the page bitmap
+HIRES_MIN_AREA = 200 * 200
+
+FIGURE_JPEG_QUALITY = 85
+
+# Opaque figures with at most this many distinct colours (charts, diagrams, icons)
+# are kept lossless as PNG; anything more colourful is treated as a photo and
+# saved as JPEG
+FIGURE_PNG_MAX_COLORS = 256
+
+# A figure whose box overlaps an image embedded in the PDF at least this much
+# (intersection over union), and contains at least EMBEDDED_IMAGE_MIN_CONTAINED
+# of that image's area, reuses the image's bytes instead of being cropped. The
+# containment check keeps a figure from picking up a larger image that also
+# holds surrounding slide content.
+EMBEDDED_IMAGE_MIN_IOU = 0.6
+EMBEDDED_IMAGE_MIN_CONTAINED = 0.9
+
+# Per-figure crop/encode workers, shared by all slides. Encoding releases the
+# GIL, so this scales with the cores available.
+CROP_ENCODE_WORKERS = os.cpu_count() or 4
+_crop_executor = ThreadPoolExecutor(max_workers=CROP_ENCODE_WORKERS)
+
+# Slides per batched API call
+ANALYSIS_BATCH_SIZE = 4
+
+# Output budget per slide in a call (override with VISION_MAX_TOKENS). Busy slides,
+# judged by the size of their encoded image, get twice the budget, and a response
+# cut off by the budget is requested again once with MAX_TOKENS_CEILING per slide.
+MAX_TOKENS_PER_SLIDE = int(os.getenv("VISION_MAX_TOKENS", "1024"))
+HEAVY_SLIDE_MAX_TOKENS = 2 * MAX_TOKENS_PER_SLIDE
+HEAVY_SLIDE_MIN_URL_LENGTH = 200_000
+MAX_TOKENS_CEILING = 4096
+
+# Hard output limit of MODEL_NAME (16384 for gpt-4o / gpt-4o-mini); no call asks
+# for more, whatever the batch size. Set VISION_MAX_OUTPUT_TOKENS along with
+# VISION_MODEL when switching to a model with a different limit.
+MODEL_MAX_OUTPUT_TOKENS = int(os.getenv("VISION_MAX_OUTPUT_TOKENS", "16384"))
+
+# Analyses of already-seen slides (template slides, dividers), keyed by a hash of
+# the downscaled slide image. A cache lives only as long as the upload it was
+# created for (see new_analysis_cache), in memory, never on disk; error
+# placeholders expire after ERROR_CACHE_TTL seconds.
+ANALYSIS_CACHE_SIZE = 256
+ERROR_CACHE_TTL = 30
+
+SLIDE_PROMPT = """You are a slide content extractor. Analyze this slide image and extract ALL text content.
 
 CRITICAL RULES:
 1. Extract EVERY piece of readable text from the slide into either "title" or "body_text"
@@ -46,24 +146,6 @@ CRITICAL RULES:
 5. For figures: ONLY create a figure entry for actual images/charts/diagrams/icons - NOT for text boxes
 6. Figure bounding boxes should EXCLUDE any text labels near them
 
-OUTPUT JSON SCHEMA:
-{
-  "layout_type": "title_only | title_and_content | two_column | diagram_heavy",
-  "title": "The exact title text from the slide",
-  "body_text": [
-    "First bullet point or paragraph - complete text",
-    "Second bullet point or paragraph - complete text",
-    "Third point..."
-  ],
-  "speaker_notes": "Brief summary for speaker notes",
-  "figures": [
-    {
-      "description": "what the image shows",
-      "box_2d": [ymin, xmin, ymax, xmax]
-    }
-  ]
-}
-
 LAYOUT TYPE GUIDE:
 - "title_only": Slide with just a title and maybe one large image
 - "title_and_content": Title with bullet points/text (most common)
@@ -75,94 +157,424 @@ COORDINATE FORMAT for figures:
 - ymin/ymax: vertical position (0=top, 1000=bottom)
 - xmin/xmax: horizontal position (0=left, 1000=right)
 
-Return ONLY valid JSON."""
-
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{base64_image}"},
-                        },
-                    ],
-                }
-            ],
-            response_format={"type": "json_object"},
-            max_tokens=4096,
-        )
-
-        content = response.choices[0].message.content
-        data = json.loads(content)
+FIELDS:
+- "title": the exact title text from the slide
+- "body_text": each bullet point or paragraph, complete text
+- "speaker_notes": brief summary for speaker notes
+- "figures": one entry per image/chart/diagram/icon, with a "description" of what it shows"""
+
+BATCH_PROMPT_PREFIX = """You will receive {count} slide images, in order. Analyze EACH image independently, following the instructions below.
+Return exactly {count} slide objects in "slides", in the same order as the images.
+
+"""
+
+# Structured output schema: the API constrains the response to it, so the model
+# cannot return stray text around the JSON or drop/rename fields
+SLIDE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "layout_type": {"type": "string", "enum": ["title_only", "title_and_content", "two_column", "diagram_heavy"]},
+        "title": {"type": "string"},
+        "body_text": {"type": "array", "items": {"type": "string"}},
+        "speaker_notes": {"type": "string"},
+        "figures": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "box_2d": {"type": "array", "items": {"type": "integer"}},
+                },
+                "required": ["description", "box_2d"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["layout_type", "title", "body_text", "speaker_notes", "figures"],
+    "additionalProperties": False,
+}
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"slides": {"type": "array", "items": SLIDE_SCHEMA}},
+    "required": ["slides"],
+    "additionalProperties": False,
+}
+
+# Analyses are only reusable for the same model, prompt and schema: fold all three
+# into every cache key, so editing the prompt invalidates old entries by itself
+_CACHE_NAMESPACE = hashlib.blake2b(
+    MODEL_NAME.encode() + SLIDE_PROMPT.encode() + json_dumps(SLIDE_SCHEMA), digest_size=16
+).digest()
+
+# Request pieces that are identical for every call, built once
+_SLIDE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "slide", "strict": True, "schema": SLIDE_SCHEMA},
+}
+_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "slide_batch", "strict": True, "schema": BATCH_SCHEMA},
+}
+_SLIDE_PROMPT_PART = {"type": "text", "text": SLIDE_PROMPT}
+
+
+@lru_cache(maxsize=ANALYSIS_BATCH_SIZE)
+def _batch_prompt_part(count: int) -> dict:
+    return {"type": "text", "text": BATCH_PROMPT_PREFIX.format(count=count) + SLIDE_PROMPT}
+
+
+def encode_image(image: Image.Image) -> str:
+    """Encode image to a base64 data URL, resizing for API efficiency."""
+    buffered = io.BytesIO()
+    # Callers normally pass an already-downscaled slide; only copy when it is not
+    if max(image.size) > ANALYSIS_MAX_DIM:
+        image = image.copy()
+        image.thumbnail((ANALYSIS_MAX_DIM, ANALYSIS_MAX_DIM))
+    
+    if image.mode in ("RGBA", "LA") and image.getextrema()[-1][0] < 255:
+        # Real transparency: keep it lossless
+        image.save(buffered, format="PNG")
+        mime_type = "image/png"
+    else:
+        # The vision model downsamples anyway; JPEG is far smaller and cheaper to encode
+        image.convert("RGB").save(buffered, format="JPEG", quality=ANALYSIS_JPEG_QUALITY,
+                                  optimize=False, progressive=False)
+        mime_type = "image/jpeg"
+    # Encode straight from the buffer's memory instead of a getvalue() copy of it
+    with buffered.getbuffer() as view:
+        return f"data:{mime_type};base64," + b64encode_as_string(view)
+
+
+def encode_figure(image: Image.Image) -> bytes:
+    """Encode a cropped figure: JPEG for photographic content, PNG for flat artwork or transparency."""
+    buffered = io.BytesIO()
+    if image.mode in ("RGB", "L") and image.getcolors(FIGURE_PNG_MAX_COLORS) is None:
+        # JPEG encodes several times faster than PNG and keeps the PPTX far smaller
+        # for photos; flat-colour artwork compresses better (and stays sharp) as PNG.
+        # getcolors() gives up as soon as it passes the limit, so photos cost ~nothing.
+        image.save(buffered, format="JPEG", quality=FIGURE_JPEG_QUALITY, optimize=False)
+    else:
+        image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+async def warm_up_client():
+    """Open the API connection ahead of the first upload (a free models listing)."""
+    try:
+        # A single attempt: an unreachable API must not hold up app startup
+        client, _ = _get_client()
+        await client.with_options(max_retries=0).models.list()
+        logger.info("Vision API connection warmed up")
+    except Exception as e:
+        logger.warning(f"Vision API warm-up failed: {e}")
+
+
+async def close_client():
+    """Close the running event loop's HTTP transport."""
+    state = _loop_clients.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state[0].close()
+
+
+def new_analysis_cache() -> OrderedDict:
+    """An empty analysis cache, shared by the analyses of a single upload and dropped with it."""
+    return OrderedDict()
+
+
+async def analyze_slide_image_async(image: Image.Image, cache: OrderedDict | None = None) -> dict:
+    """
+    Analyze a slide image and extract structured content.
+    Focus: Complete text extraction with minimal image cropping.
+    """
+    key = await asyncio.to_thread(_image_key, image) if cache is not None else None
+    return await _analyze_one(image, cache, key)
+
+
+async def analyze_slide_batch_async(images: list[Image.Image], cache: OrderedDict | None = None) -> list[dict]:
+    """
+    Analyze several slide images with a single API call, amortizing the round-trip.
+    Slides found in the cache (from new_analysis_cache) are not re-sent, and if
+    the batched response is malformed the remaining slides fall back to one call each.
+    """
+    if cache is not None:
+        keys = await asyncio.to_thread(lambda: [_image_key(image) for image in images])
+    else:
+        keys = [None] * len(images)
+    results = [_cache_get(cache, key) for key in keys]
+    misses = [i for i, data in enumerate(results) if data is None]
+    if cache is not None:
+        logger.info(f"Analysis cache: {len(images) - len(misses)} hits, {len(misses)} misses")
+
+    # Encode each missed slide once; a fallback retry re-sends the same data URL
+    # rather than encoding the slide again
+    data_urls = dict(zip(misses, await asyncio.to_thread(lambda: [encode_image(images[i]) for i in misses])))
+
+    if len(misses) > 1:
+        try:
+            slides = await _request_analysis([data_urls[i] for i in misses])
+            logger.info(f"Extracted batch of {len(slides)} slides")
+            for i, data in zip(misses, slides):
+                _cache_put(cache, keys[i], data)
+                results[i] = data
+        except Exception as e:
+            logger.warning(f"Batch analysis failed ({e}), falling back to per-slide calls")
+
+    # Anything the batch did not cover is retried one slide per call, concurrently
+    retry = [i for i in misses if results[i] is None]
+    retried = await asyncio.gather(*(_analyze_one(images[i], cache, keys[i], data_urls[i]) for i in retry))
+    for i, data in zip(retry, retried):
+        results[i] = data
+    return results
+
+
+async def analyze_slides(images: list[Image.Image]) -> list[dict]:
+    """
+    Analyze any number of slide images concurrently, ANALYSIS_BATCH_SIZE per call.
+    In-flight calls are capped by MAX_CONCURRENT_REQUESTS per event loop. Safe to
+    call through asyncio.run(): a client opened for this call is closed by it.
+    """
+    owns_client = asyncio.get_running_loop() not in _loop_clients
+    cache = new_analysis_cache()
+    batches = [images[i:i + ANALYSIS_BATCH_SIZE] for i in range(0, len(images), ANALYSIS_BATCH_SIZE)]
+    try:
+        results = await asyncio.gather(*(analyze_slide_batch_async(batch, cache) for batch in batches))
+    finally:
+        if owns_client:
+            await close_client()
+    return [data for batch in results for data in batch]
+
+
+async def _analyze_one(image: Image.Image, cache: OrderedDict | None, key: str | None,
+                       data_url: str | None = None) -> dict:
+    """Analyze a single slide through the cache, substituting a placeholder on error."""
+    cached = _cache_get(cache, key)
+    if cached is not None:
+        logger.info("Analysis cache hit")
+        return cached
+
+    try:
+        if data_url is None:
+            # Encoding is CPU-bound, keep it off the event loop
+            data_url = await asyncio.to_thread(encode_image, image)
+        data = (await _request_analysis([data_url]))[0]
         
         # Log what we got
         logger.info(f"Extracted: title='{data.get('title', '')[:50]}...', "
                    f"body_items={len(data.get('body_text', []))}, "
                    f"figures={len(data.get('figures', []))}")
         
+        _cache_put(cache, key, data)
         return data
 
     except Exception as e:
         logger.error(f"Error analyzing slide: {e}", exc_info=True)
-        return {
-            "layout_type": "title_and_content",
-            "title": "Error Processing Slide",
-            "body_text": ["Could not analyze this slide. Check logs for details."],
-            "speaker_notes": "",
-            "figures": []
-        }
+        # Remember the failure briefly so a repeated slide does not hammer the API
+        data = _error_slide()
+        _cache_put(cache, key, data, ttl=ERROR_CACHE_TTL)
+        return data
+
+
+async def _request_analysis(data_urls: list[str]) -> list[dict]:
+    """Send one or more encoded slide images in a single API call and return one dict per image."""
+    if len(data_urls) == 1:
+        prompt_part, response_format = _SLIDE_PROMPT_PART, _SLIDE_RESPONSE_FORMAT
+    else:
+        prompt_part, response_format = _batch_prompt_part(len(data_urls)), _BATCH_RESPONSE_FORMAT
+    # Only the image parts are new per call; the prompt part is a shared constant,
+    # and the message is built once even when the call is retried
+    messages = [{"role": "user", "content": [prompt_part, *map(_image_part, data_urls)]}]
+
+    max_tokens = min(sum(HEAVY_SLIDE_MAX_TOKENS if len(data_url) >= HEAVY_SLIDE_MIN_URL_LENGTH
+                         else MAX_TOKENS_PER_SLIDE for data_url in data_urls), MODEL_MAX_OUTPUT_TOKENS)
+    client, semaphore = _get_client()
+    while True:
+        async with semaphore:
+            response = await client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                response_format=response_format,
+                max_tokens=max_tokens,
+                temperature=0,
+            )
+        ceiling = min(MAX_TOKENS_CEILING * len(data_urls), MODEL_MAX_OUTPUT_TOKENS)
+        if response.choices[0].finish_reason != "length" or max_tokens >= ceiling:
+            break
+        logger.warning(f"Analysis response hit max_tokens={max_tokens}, retrying with {ceiling}")
+        max_tokens = ceiling
+
+    data = json_loads(response.choices[0].message.content)
+    if len(data_urls) == 1:
+        return [data]
+
+    # The schema fixes the shape but not the count
+    slides = data["slides"]
+    if len(slides) != len(data_urls):
+        raise ValueError(f"expected {len(data_urls)} slide objects in the batch response")
+    return slides
+
+
+def _image_part(data_url: str) -> dict:
+    return {"type": "image_url", "image_url": {"url": data_url}}
+
+
+def _error_slide() -> dict:
+    """Placeholder content for a slide that could not be analyzed."""
+    return {
+        "layout_type": "title_and_content",
+        "title": "Error Processing Slide",
+        "body_text": ["Could not analyze this slide. Check logs for details."],
+        "speaker_notes": "",
+        "figures": []
+    }
+
 
+def _image_key(image: Image.Image) -> str:
+    """Content hash of a (downscaled) slide image, used as the analysis cache key."""
+    digest = hashlib.blake2b(_CACHE_NAMESPACE, digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
 
-def crop_figures_from_slide(original_image: Image.Image, figures: list[dict]) -> list[dict]:
-    """Crop figures from the slide using AI-provided coordinates (0-1000 scale)."""
+
+def _cache_get(cache: OrderedDict | None, key: str | None) -> dict | None:
+    """Return a fresh copy of a cached analysis, or None on a miss (or without a cache)."""
+    # Caches are only touched from the event loop, so they need no lock
+    if cache is None:
+        return None
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    payload, expires_at = entry
+    if expires_at is not None and expires_at < time.monotonic():
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    # Stored serialized, so callers can mutate the result (e.g. cropped figures)
+    return json_loads(payload)
+
+
+def _cache_put(cache: OrderedDict | None, key: str | None, data: dict, ttl: float | None = None):
+    """Store an analysis, evicting the least recently used entries past the size cap."""
+    if cache is None:
+        return
+    expires_at = None if ttl is None else time.monotonic() + ttl
+    cache[key] = (json_dumps(data), expires_at)
+    cache.move_to_end(key)
+    while len(cache) > ANALYSIS_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def crop_figures_from_slide(original_image: Image.Image, figures: list[dict],
+                            render_region: Callable[[list], Image.Image] | None = None,
+                            embedded_images: list[dict] | None = None,
+                            load_embedded: Callable[[int], bytes | None] | None = None) -> list[dict]:
+    """
+    Crop figures from the slide using AI-provided coordinates (0-1000 scale).
+    
+    If embedded_images ({"box_2d", "xref"} dicts for the raster images stored
+    in the page) and load_embedded (which returns an xref's image bytes, or
+    None if they cannot be used) are given, a figure that matches one of the
+    images is taken verbatim from it. If render_region is given, other large
+    figures are rendered by it from the original document (it receives the
+    figure's box_2d) instead of being cropped from the page bitmap.
+    """
     width, height = original_image.size
-    processed_figures = []
     
-    for fig in figures:
-        box = fig.get("box_2d")
-        if not box or len(box) != 4:
-            continue
-        
-        ymin, xmin, ymax, xmax = box
-        
-        # Validate coordinates
-        if ymin >= ymax or xmin >= xmax:
-            logger.warning(f"Invalid box coordinates: {box}")
-            continue
-        
-        # Convert to pixel coordinates
-        left = int((xmin / 1000) * width)
-        top = int((ymin / 1000) * height)
-        right = int((xmax / 1000) * width)
-        bottom = int((ymax / 1000) * height)
+    figures = [fig for fig in figures if _is_box(fig.get("box_2d"))]
+    if not figures:
+        return []
+    
+    # Convert every [ymin, xmin, ymax, xmax] box to pixels and clamp to the image in one pass
+    boxes = np.asarray([fig["box_2d"] for fig in figures], dtype=np.float64)
+    bounds = np.array([height, width, height, width], dtype=np.float64)
+    pix = np.clip(boxes * bounds / 1000, 0, bounds).astype(np.int32)
+    
+    # Validate coordinates and enforce the minimum size
+    inverted = (boxes[:, 0] >= boxes[:, 2]) | (boxes[:, 1] >= boxes[:, 3])
+    sizes = pix[:, 2:] - pix[:, :2]  # (height, width) of each box
+    too_small = ~inverted & (sizes.min(axis=1) < MIN_FIGURE_SIZE)
+    for i in np.flatnonzero(inverted):
+        logger.warning(f"Invalid box coordinates: {figures[i]['box_2d']}")
+    for i in np.flatnonzero(too_small):
+        logger.warning(f"Figure too small, skipping: {sizes[i, 1]}x{sizes[i, 0]}")
+    
+    valid = np.flatnonzero(~(inverted | too_small))
+    if embedded_images and load_embedded is not None:
+        matches = _match_embedded(boxes[valid], embedded_images)
+    else:
+        matches = [None] * len(valid)
+    
+    jobs = []
+    for i, embedded in zip(valid, matches):
+        top, left, bottom, right = (int(v) for v in pix[i])
+        jobs.append((figures[i], figures[i]["box_2d"], (left, top, right, bottom), embedded))
+    
+    if len(jobs) <= 1:
+        results = [_crop_one(original_image, *job, render_region, load_embedded) for job in jobs]
+    else:
+        # Pillow releases the GIL while encoding, so figures crop in parallel
+        results = _crop_executor.map(lambda job: _crop_one(original_image, *job, render_region, load_embedded), jobs)
+    
+    return [fig_copy for fig_copy in results if fig_copy is not None]
+
+
+def _is_box(box) -> bool:
+    """A box_2d must be exactly four numbers."""
+    return (isinstance(box, (list, tuple)) and len(box) == 4
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in box))
+
+
+def _match_embedded(boxes: np.ndarray, embedded_images: list[dict]) -> list[int | None]:
+    """For each (valid) box, the xref of the embedded image it overlaps enough, if any."""
+    if len(boxes) == 0:
+        return []
+    candidates = np.asarray([img["box_2d"] for img in embedded_images], dtype=np.float64)
+    
+    # Pairwise intersection-over-union, boxes x embedded images
+    top = np.maximum(boxes[:, None, 0], candidates[None, :, 0])
+    left = np.maximum(boxes[:, None, 1], candidates[None, :, 1])
+    bottom = np.minimum(boxes[:, None, 2], candidates[None, :, 2])
+    right = np.minimum(boxes[:, None, 3], candidates[None, :, 3])
+    inter = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    candidate_area = (candidates[:, 2] - candidates[:, 0]) * (candidates[:, 3] - candidates[:, 1])
+    iou = inter / (area[:, None] + candidate_area[None, :] - inter)
+    contained = inter / candidate_area[None, :]
+    iou[contained < EMBEDDED_IMAGE_MIN_CONTAINED] = 0
+    
+    best = iou.argmax(axis=1)
+    return [
+        embedded_images[j]["xref"] if iou[i, j] >= EMBEDDED_IMAGE_MIN_IOU else None
+        for i, j in enumerate(best)
+    ]
+
+
+def _crop_one(original_image: Image.Image, fig: dict, box: list, rect: tuple, xref: int | None,
+              render_region: Callable[[list], Image.Image] | None,
+              load_embedded: Callable[[int], bytes | None] | None) -> dict | None:
+    """Crop (or render) and encode a single validated figure; None on failure."""
+    left, top, right, bottom = rect
+    try:
+        if xref is not None:
+            # Already a raster image in the PDF: use the stored bytes as-is
+            # (unless its format cannot be embedded, then crop as usual)
+            embedded = load_embedded(xref)
+            if embedded is not None:
+                fig_copy = fig.copy()
+                fig_copy["image_bytes"] = embedded
+                return fig_copy
         
-        # Clamp to image bounds
-        left = max(0, min(left, width))
-        right = max(0, min(right, width))
-        top = max(0, min(top, height))
-        bottom = max(0, min(bottom, height))
+        if render_region is not None and (right - left) * (bottom - top) >= HIRES_MIN_AREA:
+            cropped = render_region(box)
+        else:
+            cropped = original_image.crop(rect)
         
-        # Minimum size check
-        if (right - left) < 50 or (bottom - top) < 50:
-            logger.warning(f"Figure too small, skipping: {right-left}x{bottom-top}")
-            continue
+        # Free each crop's pixels as soon as it is encoded
+        fig_copy = fig.copy()
+        with cropped:
+            fig_copy["image_bytes"] = encode_figure(cropped)
+        return fig_copy
         
-        try:
-            cropped = original_image.crop((left, top, right, bottom))
-            
-            img_bytes = io.BytesIO()
-            cropped.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
-            
-            fig_copy = fig.copy()
-            fig_copy["image_bytes"] = img_bytes.read()
-            processed_figures.append(fig_copy)
-            
-        except Exception as e:
-            logger.error(f"Error cropping figure: {e}")
-            continue
-    
-    return processed_figures
+    except Exception as e:
+        logger.error(f"Error cropping figure: {e}")
+        return None